@@ -1,25 +1,56 @@
 """LCEL chain for TikZ to Matplotlib conversion using Gemini multimodal."""
 
 import re
+import asyncio
 import base64
+import hashlib
+import functools
+import shelve
+import threading
 from io import BytesIO
+from langchain_community.cache import SQLiteCache
+from langchain_core.exceptions import ModelAPIError, ModelRateLimitError
+from langchain_core.globals import set_llm_cache
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.rate_limiters import InMemoryRateLimiter
 from PIL import Image
 
-from config import GEMINI_API_KEY, MODEL_NAME
+from config import (
+    GEMINI_API_KEY, MODEL_NAME, MAX_CONCURRENCY, REQUESTS_PER_MINUTE, MAX_RETRIES,
+    LLM_CACHE_PATH, RESPONSE_CACHE_PATH
+)
+
+# Persist raw LLM responses so re-runs skip identical API calls
+set_llm_cache(SQLiteCache(database_path=LLM_CACHE_PATH))
 
+# Guards the shelve response cache (not safe for concurrent writers)
+_response_cache_lock = threading.Lock()
 
-# Initialize Gemini model
+# Initialize Gemini model (throttled across all invoke/batch calls; CHAIN owns retries)
 llm = ChatGoogleGenerativeAI(
     model=MODEL_NAME,
-    google_api_key=GEMINI_API_KEY
+    google_api_key=GEMINI_API_KEY,
+    rate_limiter=InMemoryRateLimiter(requests_per_second=REQUESTS_PER_MINUTE / 60),
+    max_retries=1
 )
 
 # Output parser
 parser = StrOutputParser()
 
+# LCEL chain: messages -> llm -> parser (built once, shared by all callers)
+# Retries rate-limit (429) and server (5xx) errors with jittered exponential backoff (1s up to 30s)
+CHAIN = (llm | parser).with_retry(
+    retry_if_exception_type=(ModelRateLimitError, ModelAPIError),
+    wait_exponential_jitter=True,
+    exponential_jitter_params={"initial": 1, "max": 30},
+    stop_after_attempt=MAX_RETRIES
+)
+
+# with_retry does not cover stream/astream, so streaming lets the Gemini SDK retry the request
+STREAM_CHAIN = llm.bind(max_retries=MAX_RETRIES) | parser
+
 # System instruction
 SYSTEM_INSTRUCTION = """You are an expert at converting TikZ code to Python Matplotlib code.
 
@@ -38,7 +69,14 @@ Rules:
 - Match the visual style, colors, and layout of the original image
 """
 
+# Match ```python ... ``` or ``` ... ```
+CODE_FENCE_RE = re.compile(r"```(?:python)?\n?(.*?)```", re.DOTALL)
+
+# One or two backticks at the end of a streamed chunk: a fence still arriving
+PARTIAL_FENCE_RE = re.compile(r"`{1,2}\s*$")
 
+
+@functools.lru_cache(maxsize=1024)
 def extract_code(response: str) -> str:
     """
     Extract clean Python code from markdown code blocks.
@@ -49,20 +87,86 @@ def extract_code(response: str) -> str:
     Returns:
         Clean Python code without markdown wrappers
     """
-    # Match ```python ... ``` or ``` ... ```
-    pattern = r"```(?:python)?\n?(.*?)```"
-    match = re.search(pattern, response, re.DOTALL)
+    match = CODE_FENCE_RE.search(response)
     return match.group(1).strip() if match else response.strip()
 
 
+def extract_partial_code(response: str) -> tuple:
+    """
+    Extract Python code from a response that may still be streaming.
+    
+    Args:
+        response: LLM response received so far
+        
+    Returns:
+        Tuple of (code so far, whether the closing fence has arrived)
+    """
+    start = response.find("```")
+    if start == -1:
+        # A trailing ` or `` may be the start of the opening fence
+        return PARTIAL_FENCE_RE.sub("", response).strip(), False
+    
+    if response.find("```", start + 3) != -1:
+        return extract_code(response), True
+    
+    body = response[start + 3:]
+    if "\n" not in body and "python".startswith(body.strip()):
+        # Still receiving the language tag
+        return "", False
+    if body.startswith("python"):
+        body = body[len("python"):]
+    # Likewise at the end: the start of the closing fence
+    return PARTIAL_FENCE_RE.sub("", body).strip(), False
+
+
+def prompt_key(caption: str, tikz_code: str, instruction: str = SYSTEM_INSTRUCTION) -> str:
+    """
+    Hash a sample's prompt inputs into a response cache key.
+    
+    The model name and instruction are part of the key so that changing
+    either invalidates previously cached code.
+    
+    Args:
+        caption: Description of the image
+        tikz_code: Original TikZ code
+        instruction: Instruction text placed before the image
+        
+    Returns:
+        Hex digest identifying the prompt
+    """
+    digest = hashlib.blake2b()
+    for part in (MODEL_NAME, instruction, caption, tikz_code):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_cached_code(key: str) -> str | None:
+    """Return previously generated code for a prompt key, if any."""
+    with _response_cache_lock, shelve.open(RESPONSE_CACHE_PATH) as cache:
+        return cache.get(key)
+
+
+def cache_code(key: str, python_code: str) -> None:
+    """Store generated code under a prompt key."""
+    with _response_cache_lock, shelve.open(RESPONSE_CACHE_PATH) as cache:
+        cache[key] = python_code
+
+
 def image_to_base64(image: Image.Image) -> str:
     """Convert PIL Image to base64 string."""
     buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+    # Fastest zlib level: PNG encode dominates, the size difference is small
+    image.save(buffered, format="PNG", compress_level=1)
+    # Encode straight from the buffer's memory, skipping the getvalue() copy
+    with buffered.getbuffer() as png:
+        return base64.b64encode(png).decode("ascii")
 
 
-def create_prompt_content(image: Image.Image, caption: str, tikz_code: str) -> list:
+def create_prompt_content(
+    image: Image.Image, caption: str, tikz_code: str, instruction: str = SYSTEM_INSTRUCTION,
+    image_b64: str | None = None
+) -> list:
     """
     Create multimodal prompt content for Gemini.
     
@@ -70,20 +174,26 @@ def create_prompt_content(image: Image.Image, caption: str, tikz_code: str) -> l
         image: PIL Image of the visualization
         caption: Description of the image
         tikz_code: Original TikZ code
+        instruction: Instruction text placed before the image
+        image_b64: Precomputed image_to_base64(image), if the caller has one
         
     Returns:
         List of content for HumanMessage
     """
-    image_b64 = image_to_base64(image)
+    if image_b64 is None:
+        image_b64 = image_to_base64(image)
     
     return [
-        {"type": "text", "text": SYSTEM_INSTRUCTION},
+        {"type": "text", "text": instruction},
         {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}},
         {"type": "text", "text": f"\n**Caption:** {caption}\n\n**TikZ Code:**\n```latex\n{tikz_code}\n```\n\nPython code:"}
     ]
 
 
-def invoke_chain(image: Image.Image, caption: str, tikz_code: str) -> str:
+def invoke_chain(
+    image: Image.Image, caption: str, tikz_code: str, instruction: str = SYSTEM_INSTRUCTION,
+    image_b64: str | None = None
+) -> str:
     """
     Invoke the LLM chain to convert TikZ to Matplotlib.
     
@@ -91,17 +201,87 @@ def invoke_chain(image: Image.Image, caption: str, tikz_code: str) -> str:
         image: PIL Image of the visualization
         caption: Description of the image
         tikz_code: Original TikZ code
+        instruction: Instruction text placed before the image
+        image_b64: Precomputed image_to_base64(image), if the caller has one
         
     Returns:
         Clean Python/Matplotlib code as string (markdown stripped)
     """
-    content = create_prompt_content(image, caption, tikz_code)
-    message = HumanMessage(content=content)
+    key = prompt_key(caption, tikz_code, instruction)
+    cached = get_cached_code(key)
+    if cached is not None:
+        return cached
     
-    # LCEL chain: message -> llm -> parser
-    chain = llm | parser
+    content = create_prompt_content(image, caption, tikz_code, instruction, image_b64)
+    message = HumanMessage(content=content)
     
-    raw_response = chain.invoke([message])
+    raw_response = CHAIN.invoke([message])
     
     # Extract clean code from markdown wrappers
-    return extract_code(raw_response)
+    python_code = extract_code(raw_response)
+    cache_code(key, python_code)
+    
+    return python_code
+
+
+def batch_invoke(messages: list, max_concurrency: int = MAX_CONCURRENCY) -> list:
+    """
+    Invoke the LLM chain on many prompts in parallel.
+    
+    Args:
+        messages: List of HumanMessage prompts, one per sample
+        max_concurrency: Maximum number of in-flight API calls
+        
+    Returns:
+        List of raw LLM responses, in the same order as messages
+    """
+    return CHAIN.batch(
+        [[message] for message in messages],
+        config={"max_concurrency": max_concurrency}
+    )
+
+
+async def astream_invoke(
+    image: Image.Image, caption: str, tikz_code: str, image_b64: str | None = None
+):
+    """
+    Stream the LLM chain, yielding code while tokens arrive.
+    
+    Streaming stops as soon as the closing code fence is received. Cache
+    access and image encoding run in worker threads to keep the event loop free.
+    
+    Args:
+        image: PIL Image of the visualization
+        caption: Description of the image
+        tikz_code: Original TikZ code
+        image_b64: Precomputed image_to_base64(image), if the caller has one
+        
+    Yields:
+        Tuples of (code so far, whether the code is complete)
+    """
+    key = prompt_key(caption, tikz_code)
+    cached = await asyncio.to_thread(get_cached_code, key)
+    if cached is not None:
+        yield cached, True
+        return
+    
+    content = await asyncio.to_thread(
+        create_prompt_content, image, caption, tikz_code, image_b64=image_b64
+    )
+    message = HumanMessage(content=content)
+    
+    buffer = ""
+    python_code, complete = "", False
+    async for chunk in STREAM_CHAIN.astream([message]):
+        buffer += chunk
+        python_code, complete = extract_partial_code(buffer)
+        yield python_code, complete
+        if complete:
+            break
+    
+    # Response ended without a closing fence
+    if not complete:
+        python_code = extract_code(buffer)
+        yield python_code, True
+    
+    await asyncio.to_thread(cache_code, key, python_code)
@@ -13,8 +13,16 @@ MODEL_NAME = "gemini-2.5-pro" #models/gemini-2.5-pro
 # Data settings
 DATA_LIMIT = 10  # Number of samples to process (for testing)
 
-# Rate limiting
-DELAY_SECONDS = 1  # Delay between API calls
+# Concurrency and rate limiting
+MAX_CONCURRENCY = 10  # Maximum in-flight API calls
+BATCH_SIZE = 32  # Prompts submitted per batch call
+ENCODE_WORKERS = 4  # Threads building prompt payloads (image encoding)
+REQUESTS_PER_MINUTE = 60  # Throttle for API calls
+MAX_RETRIES = 6  # Attempts per call when the API is overloaded (exponential backoff)
+
+# Caching
+LLM_CACHE_PATH = ".langchain.db"  # SQLite cache of raw LLM responses
+RESPONSE_CACHE_PATH = ".responses"  # Shelve of extracted code keyed by prompt hash
 
 # Output
 OUTPUT_DIR = "./output"
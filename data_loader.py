@@ -1,27 +1,40 @@
 """Load and filter the DaTikZ dataset."""
 
+from itertools import islice
 from datasets import load_dataset
 from config import DATA_LIMIT
 
 
+def is_arxiv(origins: list) -> list:
+    """Batched filter predicate: keep rows whose origin is arxiv."""
+    return [origin == "arxiv" for origin in origins]
+
+
 def load_data(limit: int = DATA_LIMIT):
     """
     Load DaTikZ dataset, filter arxiv origin, and limit rows.
     
+    With a limit, the dataset is streamed and only the shards needed to
+    collect `limit` samples are downloaded. Without one, the full split is
+    loaded as a memory-mapped Arrow dataset.
+    
     Args:
         limit: Maximum number of rows to return
         
     Returns:
-        Filtered dataset with arxiv samples only
+        List of arxiv sample dicts, or the filtered Arrow dataset if no limit
     """
-    # Load dataset
-    dataset = load_dataset("nllg/datikz-v3", split="train")
+    if not limit:
+        dataset = load_dataset("nllg/datikz-v3", split="train")
+        # Filter arxiv origin only (batched over the origin column, images stay undecoded)
+        return dataset.filter(is_arxiv, input_columns="origin", batched=True)
     
-    # Filter arxiv origin only
-    dataset = dataset.filter(lambda x: x["origin"] == "arxiv")
+    # Stream dataset instead of downloading the full corpus
+    dataset = load_dataset("nllg/datikz-v3", split="train", streaming=True)
     
-    # Limit rows
-    if limit:
-        dataset = dataset.select(range(min(limit, len(dataset))))
+    # Filter arxiv origin only; the predicate sees just the origin column, but
+    # whole rows (images included) are still read from the stream
+    dataset = dataset.filter(is_arxiv, input_columns="origin", batched=True)
     
-    return dataset
+    # Limit rows
+    return list(islice(dataset, limit))
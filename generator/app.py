@@ -6,54 +6,14 @@ import os
 # Add parent directory to path to import existing modules
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-import io
+import asyncio
+import functools
 import gradio as gr
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from PIL import Image
 
 # Import from existing modules (no duplication!)
 from data_loader import load_data
-from chain import invoke_chain
-
-
-def execute_code(python_code: str) -> Image.Image:
-    """Execute Python code and capture the matplotlib figure as an image."""
-    plt.close('all')
-    
-    namespace = {"plt": plt, "__builtins__": __builtins__}
-    
-    try:
-        exec(python_code, namespace)
-        fig = plt.gcf()
-        
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', dpi=150, bbox_inches='tight', 
-                    facecolor='white', edgecolor='none')
-        buf.seek(0)
-        
-        img = Image.open(buf).copy()
-        buf.close()
-        plt.close('all')
-        
-        return img
-    except Exception as e:
-        fig, ax = plt.subplots(figsize=(6, 4))
-        ax.text(0.5, 0.5, f"Error:\n{str(e)[:100]}", 
-                ha='center', va='center', fontsize=10, color='red',
-                transform=ax.transAxes, wrap=True)
-        ax.axis('off')
-        
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                    facecolor='white')
-        buf.seek(0)
-        img = Image.open(buf).copy()
-        buf.close()
-        plt.close('all')
-        
-        return img
+from chain import invoke_chain, astream_invoke, image_to_base64
+from renderer import render_code as execute_code
 
 
 # Load dataset using existing data_loader
@@ -63,6 +23,12 @@ TOTAL = len(DATA)
 print(f"Loaded {TOTAL} samples")
 
 
+@functools.cache
+def sample_image_b64(index: int) -> str:
+    """Encode a sample's image once; retries and regenerations reuse it."""
+    return image_to_base64(DATA[index]["image"])
+
+
 def get_sample_info(index: int):
     """Get sample info without generating."""
     sample = DATA[index]
@@ -82,7 +48,8 @@ def generate_matplotlib(index: int):
     python_code = invoke_chain(
         image=sample["image"],
         caption=sample["caption"],
-        tikz_code=sample["code"]
+        tikz_code=sample["code"],
+        image_b64=sample_image_b64(index)
     )
     
     # Execute the generated code
@@ -138,22 +105,24 @@ with gr.Blocks(theme=gr.themes.Soft()) as app:
     def go_next(idx):
         return navigate(idx, 1)
     
-    def run_generate(idx):
-        """Yield progressive updates: Code first, then Image."""
+    async def run_generate(idx):
+        """Yield progressive updates: Code token-by-token, then Image."""
         sample = DATA[idx]
+        image_b64 = await asyncio.to_thread(sample_image_b64, idx)
         
-        # 1. Generate Code (Yield immediately)
-        python_code = invoke_chain(
+        # 1. Stream Code (Yield as tokens arrive, stops at the closing fence)
+        python_code = ""
+        async for python_code, _ in astream_invoke(
             image=sample["image"],
             caption=sample["caption"],
-            tikz_code=sample["code"]
-        )
-        
-        # Yield code + placeholder/loading image
-        yield None, python_code
+            tikz_code=sample["code"],
+            image_b64=image_b64
+        ):
+            # Yield partial code + placeholder/loading image
+            yield None, python_code
         
-        # 2. Generate Image
-        gen_img = execute_code(python_code)
+        # 2. Generate Image (in a worker thread, keeping the event loop free)
+        gen_img = await asyncio.to_thread(execute_code, python_code)
         
         # Yield final image + code
         yield gen_img, python_code
@@ -188,5 +157,7 @@ with gr.Blocks(theme=gr.themes.Soft()) as app:
 
 
 if __name__ == "__main__":
+    # Let several sessions generate at once
+    app.queue(default_concurrency_limit=8)
     app.launch()
 
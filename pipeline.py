@@ -1,61 +1,186 @@
-"""Pipeline to process dataset row-by-row."""
+"""Pipeline to process the dataset in batches with `Dataset.map`."""
 
 import os
-import json
-import time
-from tqdm import tqdm
+import hashlib
+import orjson
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from datasets import Dataset, Image as ImageFeature
+from langchain_core.messages import HumanMessage
+from PIL import Image
 
-from config import DELAY_SECONDS, OUTPUT_DIR
-from chain import invoke_chain
+from config import BATCH_SIZE, ENCODE_WORKERS, MAX_CONCURRENCY, OUTPUT_DIR
+from chain import (
+    batch_invoke, cache_code, create_prompt_content, extract_code,
+    get_cached_code, prompt_key
+)
+from template_cache import build_renderer, fingerprint, render
 
 
-def process_row(row: dict) -> dict:
+def create_message(row: dict) -> HumanMessage:
     """
-    Process a single row: invoke LLM and add python_code.
+    Build the multimodal prompt message for a single row.
     
     Args:
         row: Dataset row with image, caption, code
         
     Returns:
-        Row with added python_code field
+        HumanMessage ready to send to the chain
     """
-    python_code = invoke_chain(
-        image=row["image"],
-        caption=row["caption"],
-        tikz_code=row["code"]
-    )
+    content = create_prompt_content(row["image"], row["caption"], row["code"])
+    return HumanMessage(content=content)
+
+
+def apply_templates(
+    rows: list, keys: list, python_codes: list, pending: list, max_concurrency: int
+) -> list:
+    """
+    Fill in code for rows whose TikZ shares a template with other rows.
+    
+    Rows matching a template built earlier are rendered directly. Otherwise
+    the first row of each template cluster gets a parameterized generator
+    from the LLM and the remaining rows are rendered from it.
+    
+    Args:
+        rows: Dataset rows with image, caption, code
+        keys: Response cache key per row
+        python_codes: Generated code per row, updated in place
+        pending: Indices of rows that still need code
+        max_concurrency: Maximum number of in-flight API calls
+        
+    Returns:
+        Indices of rows that still need a regular LLM call
+    """
+    clusters = defaultdict(list)
+    for i in pending:
+        python_codes[i] = render(rows[i]["code"])
+        if python_codes[i] is None:
+            clusters[fingerprint(rows[i]["code"])].append(i)
     
-    return {**row, "python_code": python_code}
+    templates = [members for members in clusters.values() if len(members) > 1]
+    first_rows = [rows[members[0]] for members in templates]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        first_codes = list(executor.map(
+            lambda row: build_renderer(row["image"], row["caption"], row["code"]), first_rows
+        ))
+    
+    for members, first_code in zip(templates, first_codes):
+        if first_code is None:
+            continue
+        python_codes[members[0]] = first_code
+        for i in members[1:]:
+            python_codes[i] = render(rows[i]["code"])
+    
+    # Cache rendered rows so reruns don't rebuild them from generated source
+    remaining = []
+    for i in pending:
+        if python_codes[i] is None:
+            remaining.append(i)
+        else:
+            cache_code(keys[i], python_codes[i])
+    
+    return remaining
 
 
-def process_dataset(dataset) -> list:
+def process_batch(batch: dict, max_concurrency: int = MAX_CONCURRENCY) -> dict:
     """
-    Process entire dataset row-by-row with rate limiting.
+    Generate python_code for a batch of rows (batched `Dataset.map` function).
     
     Args:
-        dataset: HuggingFace dataset
+        batch: Columns of the batch (image, caption, code, ...)
+        max_concurrency: Maximum number of in-flight API calls
         
     Returns:
-        List of processed rows with python_code added
+        New python_code column for the batch
+    """
+    rows = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    keys = [prompt_key(row["caption"], row["code"]) for row in rows]
+    
+    # Reuse code from previous runs; only uncached rows go to the LLM
+    python_codes = [get_cached_code(key) for key in keys]
+    pending = [i for i, code in enumerate(python_codes) if code is None]
+    pending = apply_templates(rows, keys, python_codes, pending, max_concurrency)
+    
+    # Encode prompt payloads in worker threads (PIL releases the GIL)
+    with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as executor:
+        messages = list(executor.map(create_message, [rows[i] for i in pending]))
+    
+    # One batch call; CHAIN.batch keeps max_concurrency requests in flight
+    responses = batch_invoke(messages, max_concurrency) if messages else []
+    for i, response in zip(pending, responses):
+        python_codes[i] = extract_code(response)
+        cache_code(keys[i], python_codes[i])
+    
+    return {"python_code": python_codes}
+
+
+def process_dataset(dataset, max_concurrency: int = MAX_CONCURRENCY) -> Dataset:
     """
-    results = []
+    Process entire dataset with batched, concurrent LLM calls.
     
-    for row in tqdm(dataset, desc="Processing"):
-        processed = process_row(row)
-        results.append(processed)
+    Args:
+        dataset: HuggingFace dataset or list of sample dicts
+        max_concurrency: Maximum number of in-flight API calls
         
-        # Rate limiting
-        time.sleep(DELAY_SECONDS)
+    Returns:
+        Dataset with python_code column added, in original order (empty
+        list for empty input)
+    """
+    if len(dataset) == 0:
+        return []
+    
+    if not isinstance(dataset, Dataset):
+        # Note: datasets re-encodes the decoded PIL images to PNG here, so the
+        # images later written by save_results are this encode, not the source bytes
+        dataset = Dataset.from_list(list(dataset))
+    
+    # Fingerprint the output from the prompts, so datasets never has to hash the LLM client
+    digest = hashlib.blake2b(digest_size=32)
+    for caption, tikz_code in zip(dataset["caption"], dataset["code"]):
+        digest.update(prompt_key(caption, tikz_code).encode("utf-8"))
+    
+    return dataset.map(
+        process_batch,
+        batched=True,
+        batch_size=BATCH_SIZE,
+        fn_kwargs={"max_concurrency": max_concurrency},
+        new_fingerprint=digest.hexdigest(),
+        desc="Processing"
+    )
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def save_image(image: dict, path: str) -> None:
+    """
+    Write an undecoded `Image` feature value to a PNG file.
+    
+    PNG bytes are written as-is; other formats are decoded and re-encoded.
+    
+    Args:
+        image: Dict with the stored image "bytes" (or a source "path")
+        path: Destination PNG path
+    """
+    data = image["bytes"]
+    if data is None:
+        with open(image["path"], "rb") as f:
+            data = f.read()
     
-    return results
+    if data.startswith(PNG_SIGNATURE):
+        with open(path, "wb") as f:
+            f.write(data)
+    else:
+        Image.open(BytesIO(data)).save(path, "PNG", optimize=False, compress_level=1)
 
 
-def save_results(results: list) -> str:
+def save_results(results) -> str:
     """
     Save processed results to JSON file and images to images/ folder.
     
     Args:
-        results: List of processed rows
+        results: Processed dataset with python_code (or an empty list)
         
     Returns:
         Path to saved JSON file
@@ -65,22 +190,28 @@ def save_results(results: list) -> str:
     os.makedirs(images_dir, exist_ok=True)
     
     output_path = os.path.join(OUTPUT_DIR, "dataset.json")
+    if len(results) == 0:
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps([]))
+        return output_path
+    
+    image_filenames = [f"sample_{i:04d}.png" for i in range(len(results))]
+    
+    # Write the stored image bytes straight to disk, without decoding them
+    raw_images = results.cast_column("image", ImageFeature(decode=False))["image"]
+    saved = [(image, name) for image, name in zip(raw_images, image_filenames) if image]
+    images = [image for image, _ in saved]
+    image_paths = [os.path.join(images_dir, name) for _, name in saved]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(save_image, images, image_paths))
     
     serializable_results = []
-    for i, row in enumerate(results):
-        # Save image as PNG file
-        image_filename = f"sample_{i:04d}.png"
-        image_path = os.path.join(images_dir, image_filename)
-        
-        if row.get("image"):
-            row["image"].save(image_path, "PNG")
-        
-        # Create serializable row with image path instead of PIL object
-        row_copy = {k: v for k, v in row.items() if k != "image"}
-        row_copy["image_path"] = f"images/{image_filename}"
-        serializable_results.append(row_copy)
+    for row, image_filename in zip(results.remove_columns("image"), image_filenames):
+        # Serializable row with image path instead of the image
+        row["image_path"] = f"images/{image_filename}"
+        serializable_results.append(row)
     
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(serializable_results, f, indent=2, default=str)
+    with open(output_path, "wb") as f:
+        f.write(orjson.dumps(serializable_results, option=orjson.OPT_INDENT_2, default=str))
     
     return output_path
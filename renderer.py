@@ -0,0 +1,97 @@
+"""Execute generated Matplotlib code and render the figure as an image."""
+
+import io
+import math
+import functools
+import threading
+import matplotlib
+matplotlib.use('Agg')  # Non-interactive backend
+import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image
+
+
+# pyplot keeps global figure state, so renders from worker threads must not overlap
+_render_lock = threading.Lock()
+
+# Names every generated script can use without importing them again
+BASE_NAMESPACE = {"plt": plt, "np": np, "math": math, "__builtins__": __builtins__}
+
+
+@functools.lru_cache(maxsize=128)
+def compile_code(python_code: str):
+    """Compile Python code once; re-running the same code reuses the code object."""
+    return compile(python_code, "<generated>", "exec")
+
+
+# Resolution of rendered figures
+RENDER_DPI = 150
+
+
+# Scratch buffer reused across renders; safe because renders hold _render_lock
+_render_buf = io.BytesIO()
+
+
+def _savefig(fig, fmt: str) -> int:
+    """Write the figure into the scratch buffer and return the number of bytes written."""
+    # Rewind without truncating, so the buffer keeps its capacity between renders
+    _render_buf.seek(0)
+    fig.savefig(_render_buf, format=fmt, dpi=RENDER_DPI, bbox_inches='tight',
+                facecolor='white', edgecolor='none')
+    return _render_buf.tell()
+
+
+def figure_to_image(fig) -> Image.Image:
+    """Render a figure like savefig(bbox_inches='tight'), as raw RGBA instead of PNG."""
+    length = _savefig(fig, 'rgba')
+    
+    # The Agg renderer savefig just used has the size of the tight canvas
+    renderer = fig.canvas.renderer
+    size = (int(renderer.width), int(renderer.height))
+    if length == size[0] * size[1] * 4:
+        # frombytes copies, and the view is released before the buffer is written again
+        with _render_buf.getbuffer() as view:
+            return Image.frombytes('RGBA', size, view[:length])
+    
+    # Unexpected canvas size: fall back to a PNG round-trip
+    _savefig(fig, 'png')
+    _render_buf.seek(0)
+    return Image.open(_render_buf).copy()
+
+
+def render_code(python_code: str) -> Image.Image:
+    """
+    Execute Python code and capture the matplotlib figure as an image.
+    
+    Args:
+        python_code: Python/Matplotlib code to execute
+        
+    Returns:
+        PIL Image of the generated figure
+    """
+    with _render_lock:
+        try:
+            # Execute the (cached) compiled code in a fresh copy of the namespace
+            exec(compile_code(python_code), {**BASE_NAMESPACE})
+            
+            # Get current figure
+            fig = plt.gcf()
+            
+            # Convert to PIL Image straight from the canvas (no PNG round-trip)
+            img = figure_to_image(fig)
+            plt.close('all')
+            
+            return img
+        except Exception as e:
+            # Return error image
+            fig, ax = plt.subplots(figsize=(6, 4))
+            ax.text(0.5, 0.5, f"Error:\n{str(e)[:100]}", 
+                    ha='center', va='center', fontsize=10, color='red',
+                    transform=ax.transAxes, wrap=True)
+            ax.axis('off')
+            
+            img = figure_to_image(fig)
+            plt.close('all')
+            
+            return img
+
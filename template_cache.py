@@ -0,0 +1,120 @@
+"""Reuse one LLM-generated program across TikZ samples sharing a template."""
+
+import hashlib
+import re
+
+from chain import SYSTEM_INSTRUCTION, invoke_chain
+
+
+# Numeric and quoted-string literals; everything else is template structure
+LITERAL_RE = re.compile(r'"[^"\n]*"|(?<![\w.])-?\d+(?:\.\d+)?')
+
+# Instruction asking for a parameterized generator instead of plain code
+TEMPLATE_INSTRUCTION = SYSTEM_INSTRUCTION + """
+This TikZ code is a template shared by several samples that differ only in their
+numeric and quoted-string literals. Instead of a plain script, write a Python
+function `render(params)` that RETURNS, as a string, the complete Matplotlib
+script for a sample. `params` is the list of literals from that sample's TikZ
+code, in order of appearance, as strings. For this sample:
+
+params = {params}
+
+Return ONLY the definition of `render` (and any imports it needs).
+"""
+
+# Compiled render functions keyed by TikZ fingerprint
+_renderers = {}
+
+
+def _placeholder(match: re.Match) -> str:
+    """Replace a literal with its type token."""
+    return "<STR>" if match.group().startswith('"') else "<NUM>"
+
+
+def fingerprint(tikz_code: str) -> str:
+    """
+    Compute a structural fingerprint of TikZ code.
+
+    Args:
+        tikz_code: Original TikZ code
+
+    Returns:
+        Hex digest that is equal for snippets differing only by literals
+    """
+    structure = LITERAL_RE.sub(_placeholder, tikz_code)
+    structure = " ".join(structure.split())
+    return hashlib.blake2b(structure.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def extract_params(tikz_code: str) -> list:
+    """Extract the literals of TikZ code in order of appearance."""
+    return LITERAL_RE.findall(tikz_code)
+
+
+def _checked_code(python_code) -> str | None:
+    """Return python_code if it is a string of valid Python, else None."""
+    if not isinstance(python_code, str):
+        return None
+
+    try:
+        compile(python_code, "<template>", "exec")
+    except (SyntaxError, ValueError):
+        return None
+
+    return python_code
+
+
+def render(tikz_code: str) -> str | None:
+    """
+    Generate Python code from a cached template, bypassing the LLM.
+
+    Args:
+        tikz_code: Original TikZ code
+
+    Returns:
+        Python/Matplotlib code, or None if no template matches, it fails, or
+        it produces invalid Python
+    """
+    renderer = _renderers.get(fingerprint(tikz_code))
+    if renderer is None:
+        return None
+
+    try:
+        python_code = renderer(extract_params(tikz_code))
+    except Exception:
+        return None
+
+    return _checked_code(python_code)
+
+
+def build_renderer(image, caption: str, tikz_code: str) -> str | None:
+    """
+    Ask the LLM for a `render(params)` generator and cache it for the template.
+
+    Args:
+        image: PIL Image of the visualization
+        caption: Description of the image
+        tikz_code: Original TikZ code
+
+    Returns:
+        Python/Matplotlib code for this sample, or None if the generated
+        render function is unusable or produces invalid Python
+    """
+    params = extract_params(tikz_code)
+    instruction = TEMPLATE_INSTRUCTION.replace("{params}", repr(params))
+    source = invoke_chain(image, caption, tikz_code, instruction=instruction)
+
+    namespace = {}
+    try:
+        exec(source, namespace)
+        renderer = namespace["render"]
+        python_code = renderer(params)
+    except Exception:
+        return None
+
+    python_code = _checked_code(python_code)
+    if python_code is None:
+        return None
+
+    _renderers[fingerprint(tikz_code)] = renderer
+    return python_code
@@ -1,13 +1,17 @@
 """Gradio app for comparing original TikZ images with generated Matplotlib images."""
 
+import sys
+import os
+
+# Add parent directory to path to import the shared renderer
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 import json
-import io
 import gradio as gr
-import matplotlib
-matplotlib.use('Agg')  # Non-interactive backend
-import matplotlib.pyplot as plt
 from PIL import Image
 
+from renderer import render_code as execute_code
+
 # Path to dataset
 DATA_PATH = "../output/dataset.json"
 
@@ -18,60 +22,6 @@ def load_data():
         return json.load(f)
 
 
-def execute_code(python_code: str) -> Image.Image:
-    """
-    Execute Python code and capture the matplotlib figure as an image.
-    
-    Args:
-        python_code: Python/Matplotlib code to execute
-        
-    Returns:
-        PIL Image of the generated figure
-    """
-    # Clear any existing figures
-    plt.close('all')
-    
-    # Create a namespace for execution
-    namespace = {"plt": plt, "__builtins__": __builtins__}
-    
-    try:
-        # Execute the code
-        exec(python_code, namespace)
-        
-        # Get current figure
-        fig = plt.gcf()
-        
-        # Save to buffer
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', dpi=150, bbox_inches='tight', 
-                    facecolor='white', edgecolor='none')
-        buf.seek(0)
-        
-        # Convert to PIL Image
-        img = Image.open(buf).copy()
-        buf.close()
-        plt.close('all')
-        
-        return img
-    except Exception as e:
-        # Return error image
-        fig, ax = plt.subplots(figsize=(6, 4))
-        ax.text(0.5, 0.5, f"Error:\n{str(e)[:100]}", 
-                ha='center', va='center', fontsize=10, color='red',
-                transform=ax.transAxes, wrap=True)
-        ax.axis('off')
-        
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', dpi=150, bbox_inches='tight',
-                    facecolor='white')
-        buf.seek(0)
-        img = Image.open(buf).copy()
-        buf.close()
-        plt.close('all')
-        
-        return img
-
-
 def get_sample(index: int, data: list):
     """Get a sample by index and return both images."""
     sample = data[index]